@@ -23,14 +23,61 @@ DC.Rights:          [e.g., MIT License, Copyright 2025 Autumn Denny]
 ================================================================================
 """
 
+import os
+import sys
+import multiprocessing
 import scispacy
 import spacy
+import torch
+from functools import lru_cache
+from parsing import genCleaned
 
-# Setting to sciBERT, we'll see how it goes and adjust as needed. Supposedly SciSpaCy has an entity linker to play with too.
-languageProcessor = spacy.load("en_core_sci_scibert")
+# Global vars
+# Batch size and worker count for languageProcessor.pipe; override with NERVE_BATCH_SIZE / NERVE_NPROC.
+# Set NERVE_NPROC=1 when running on a GPU: worker processes can't share the GPU, so they'd just fight over it.
+# With more than one worker, classifyDocuments pins torch to one thread per worker (see there).
+batchSize = int(os.environ.get('NERVE_BATCH_SIZE', 64))
+numProcesses = int(os.environ.get('NERVE_NPROC', max(1, (os.cpu_count() or 1) - 1)))
+# Pipeline components nothing downstream uses yet. Excluded ones are never loaded, which matters once n_process > 1
+# copies the pipeline into every worker. Take one out of this list when something starts relying on it.
+excludedPipes = ['ner', 'lemmatizer', 'attribute_ruler', 'parser']
 
 
-import os
-for file in os.listdir('test_txts'):
-    
+@lru_cache(maxsize=1)
+def getLanguageProcessor():
+    """
+    Input: None.
+    Output: languageProcessor (spacy Language | loaded sciBERT pipeline)
+    Purpose: Loads the sciBERT pipeline on first use and hands back the same object after that, so importing this module
+             doesn't cost a model load (or fail when the model isn't installed).
+    """
+    # Setting to sciBERT, we'll see how it goes and adjust as needed. Supposedly SciSpaCy has an entity linker to play with too.
+    languageProcessor = spacy.load("en_core_sci_scibert", exclude=excludedPipes)
+    # The parser was only giving us sentence boundaries; the rule-based sentencizer does that for a fraction of the cost.
+    languageProcessor.add_pipe("sentencizer")
+    return languageProcessor
+
+
+def classifyDocuments(texts):
+    """
+    Input: texts (iterable of (str, str) | (cleanedText, fileName) tuples, e.g. from parsing.genCleaned)
+    Output: generator of (doc, fileName) tuples (spacy Doc, str)
+    Purpose: Runs the cleaned texts through sciBERT in batches, spread across worker processes.
+    """
+    # torch defaults to a thread per core in every process, so N workers would start ~N x cores threads. One thread each
+    # keeps it to ~N. Set in the parent so forked workers inherit it.
+    if numProcesses > 1:
+        torch.set_num_threads(1)
+    for doc, fileName in getLanguageProcessor().pipe(texts, as_tuples=True, batch_size=batchSize, n_process=numProcesses):
+        yield doc, fileName
+
 
+# Guarded so worker processes spawned by pipe() don't re-run the pipeline on import (needed on Windows/macOS).
+if __name__ == "__main__":
+    # classifyDocuments loads the model here in the parent before pipe() starts its workers. With fork, the workers get
+    # its memory copy-on-write instead of each holding their own copy. (Python 3.14+ no longer defaults to fork on Linux.)
+    # Windows/macOS spawn instead, where pipe() ships each worker the pipeline once up front.
+    if sys.platform.startswith('linux'):
+        multiprocessing.set_start_method('fork')
+    for doc, fileName in classifyDocuments(genCleaned()):
+        print('[NERVE-bio] Processed: ' + fileName + ' (' + str(len(doc)) + ' tokens)')
@@ -24,7 +24,19 @@ DC.Rights:          TBD
 import pymupdf
 import ftfy
 import pytesseract   # nts: actually implement this 
+import io
 import os
+import re
+import asyncio
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache
+from itertools import repeat
+try:
+    from numba import njit
+except ImportError:   # numba is optional; checktextQuality falls back to plain numpy without it.
+    njit = None
 
 # TODO: (originally, this is a "proof of concept" before proposing it)
 # 1. Add docstrings and typehints.
@@ -40,6 +52,14 @@ import os
 testPDFDir = 'test_pdfs'
 testTXTDir = 'test_txts'
 qualityScoreThreshold = 0.92
+debugMode = False   # Prints every word checktextQuality flags as invalid.
+qualityCheckBlockWords = 1024   # checktextQuality checks whether the verdict is settled after every block of this many words.
+# Default text flags minus ligature preservation, so MuPDF expands ﬁ/ﬂ/etc. itself in C instead of leaving them for fixText.
+textExtractionFlags = pymupdf.TEXTFLAGS_TEXT & ~pymupdf.TEXT_PRESERVE_LIGATURES
+# genCleaned splits long PDFs' pages across a pool of this many worker processes (see extractPDFText); 1 turns it off.
+# minPagesForPageWorkers is a starting guess, not a measurement -- tune both with NERVE_PAGE_WORKERS / NERVE_MIN_SPLIT_PAGES.
+pageWorkers = int(os.environ.get('NERVE_PAGE_WORKERS', min(8, os.cpu_count() or 1)))
+minPagesForPageWorkers = int(os.environ.get('NERVE_MIN_SPLIT_PAGES', 50))
 
 
 # Allowed and disallowed characters.
@@ -55,6 +75,36 @@ whiteListedChars = {'◦','˚','°'}
 # Used ChatGPT to generate blacklisted characters.
 blackListedChars = {'¤','§','©','®','¶','•','†','‡','◦','˚','※','⁂','‽','⁉','‥','☺','☻','♥','♦','♣','♠','✦','✧','★','☆','✪','☀','☁','☂','☃','☄','\uFFFD','\u200B','\u200C','\u200D','\u2060','\uFEFF','\u202A','\u202B','\u202C','\u202D','\u202E','\u2066','\u2067','\u2068','\u2069','\u25AA','\u25AB','\u25B6','\u25C0'}
 allowedEscapedChars = ['\n', '\r', '\t']
+# Matches any single character checkInvalidChars would flag: anything outside the allowed ranges (minus whitelisted and
+# escaped chars), or a blacklisted char that isn't whitelisted. Compiled once so the scan runs in C, not per char in Python.
+invalidCharPattern = re.compile(
+    '[^' + ''.join('\\u%04x-\\u%04x' % (start, end) for start, end in allowedChars)
+    + re.escape(''.join(sorted(whiteListedChars))) + re.escape(''.join(allowedEscapedChars)) + ']'
+    + '|[' + re.escape(''.join(sorted(blackListedChars - whiteListedChars))) + ']'
+)
+# Same rules as lookup tables indexed by codepoint, for the vectorized scan in checktextQuality. Every allowed char and
+# everything str.split() splits on lives in the BMP, so higher codepoints get clamped to U+FFFF, which is in neither table.
+allowedBitmap = np.zeros(0x10000, dtype=bool)
+for start, end in allowedChars:
+    allowedBitmap[start:end + 1] = True
+allowedBitmap[[ord(char) for char in blackListedChars]] = False
+allowedBitmap[[ord(char) for char in whiteListedChars | set(allowedEscapedChars)]] = True
+whitespaceBitmap = np.array([chr(code).isspace() for code in range(0x10000)], dtype=bool)
+
+# Google's Gemini was used to compile a list of ligatures.
+ligatures = {'ﬀ': 'ff', 'ﬁ': 'fi', 'ﬂ': 'fl', 'ﬃ': 'ffi','ﬄ': 'ffl', 'æ': 'ae','œ': 'oe'}
+# ChatGPT for broken accents.
+brokenAccents = {'ı´':'í','I´':'Í','i´':'í','a´':'á','A´':'Á','e´':'é','E´':'É','o´':'ó','O´':'Ó','u´':'ú','U´':'Ú','n~':'ñ','N~':'Ñ','c¸':'ç','C¸':'Ç','a`':'à','A`':'À','e`':'è','E`':'È','i`':'ì','I`':'Ì','o`':'ò','O`':'Ò','u`':'ù','U`':'Ù','a^':'â','A^':'Â','e^':'ê','E^':'Ê','i^':'î','I^':'Î','o^':'ô','O^':'Ô','u^':'û','U^':'Û','a¨':'ä','A¨':'Ä','e¨':'ë','E¨':'Ë','i¨':'ï','I¨':'Ï','o¨':'ö','O¨':'Ö','u¨':'ü','U¨':'Ü'}
+# Built once here instead of on every fixText/cleanText call. Single-char fixes go in a translate table, anything
+# longer goes in one alternation regex (longest keys first), whichever dict they came from.
+textFixes = {**ligatures, **brokenAccents}
+singleCharFixTable = str.maketrans({key: value for key, value in textFixes.items() if len(key) == 1})
+multiCharFixes = {key: value for key, value in textFixes.items() if len(key) > 1}
+multiCharFixPattern = re.compile('|'.join(re.escape(key) for key in sorted(multiCharFixes, key=len, reverse=True)))
+blackListTable = str.maketrans(dict.fromkeys(blackListedChars))
+blackListPattern = re.compile('[' + re.escape(''.join(sorted(blackListedChars))) + ']')
+# The ASCII chars ftfy still rewrites: control chars/terminal escapes (removed), CR line breaks (to LF), HTML entities.
+asciiFtfyPattern = re.compile(r'[\x00-\x08\x0b\x0e-\x1f\x7f\r&]')
 
 def getNewTXTPath(fileName):
     """
@@ -65,6 +115,34 @@ def getNewTXTPath(fileName):
     txtPath = os.path.join(testTXTDir, fileName[:-4] + '.txt')
     return txtPath
 
+def writeTXT(txtPath, text):
+    """
+    Input: txtPath (str | path of txt file to write), text (str | text to store)
+    Output: None.
+    Purpose: Writes text to txtPath as UTF-8 in one go: encode once, then os.write the whole buffer, skipping the text-mode
+             file object and its small internal writes.
+    """
+    data = memoryview(text.encode('utf-8'))
+    # O_BINARY so Windows doesn't translate newlines; it doesn't exist (and isn't needed) elsewhere.
+    fd = os.open(txtPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        # os.write can write less than asked for on big buffers, so keep going from where it stopped.
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
+def listPDFs():
+    """
+    Input: None.
+    Output: pdfFiles (list | names of the .pdf files in the PDF directory)
+    Purpose: Lists the PDFs to transcribe, skipping subdirectories and anything that isn't a .pdf (.DS_Store etc.).
+             scandir's entries already know if they're files, so this doesn't stat every name.
+    """
+    with os.scandir(testPDFDir) as entries:
+        pdfFiles = [entry.name for entry in entries if entry.is_file() and entry.name.lower().endswith('.pdf')]
+    return pdfFiles
+
 def textSlicer(sampleText):
     """
     Input: sampleText (str | text from transcribed .txt)
@@ -75,6 +153,9 @@ def textSlicer(sampleText):
     return words
 
 # This is all a heuristic ###. Sorry.
+# Not on the scoring path (checktextQuality uses the codepoint tables); the debugMode listing is the only caller. The
+# small cache just saves re-checking repeated words there, and cache_info() in that listing shows whether it helps.
+@lru_cache(maxsize=4096)
 def checkInvalidChars(word):
     """
     Input: word (str | single word)
@@ -82,19 +163,7 @@ def checkInvalidChars(word):
     Purpose: Checks for any super weird characters that came out of parsing errors. Labels word as invalid (True) or valid (False).
              Assumes validity.
     """
-    isInvalid = False
-    for char in word:
-        if char in allowedEscapedChars:
-            continue
-        elif char in whiteListedChars:
-            continue
-        else:
-            ordChar = ord(char)
-            isInRange = any(start <= ordChar <= end for start, end in allowedChars)
-            if not isInRange:
-                isInvalid = True
-            elif char in blackListedChars:
-                isInvalid = True
+    isInvalid = invalidCharPattern.search(word) is not None
     return isInvalid
 
 # nto: Noticed ligatures and broken accents from test run.
@@ -104,15 +173,11 @@ def fixText(text):
     Output: text (str | text that was fixed in-place to translate ligatures)
     Purpose: Replaces ligatures and accents in text that would otherwise be flagged as invalid characters.
     """
-    # Google's Gemini was used to compile a list of ligatures.
-    ligatures = {'ﬀ': 'ff', 'ﬁ': 'fi', 'ﬂ': 'fl', 'ﬃ': 'ffi','ﬄ': 'ffl', 'æ': 'ae','œ': 'oe'}
-    for key in ligatures.keys():
-        text = text.replace(key, ligatures[key])
-    # ChatGPT for broken accents.
-    brokenAccents = {'ı´':'í','I´':'Í','i´':'í','I´':'Í','a´':'á','A´':'Á','e´':'é','E´':'É','o´':'ó','O´':'Ó','u´':'ú','U´':'Ú','n~':'ñ','N~':'Ñ','c¸':'ç','C¸':'Ç','a`':'à','A`':'À','e`':'è','E`':'È','i`':'ì','I`':'Ì','o`':'ò','O`':'Ò','u`':'ù','U`':'Ù','a^':'â','A^':'Â','e^':'ê','E^':'Ê','i^':'î','I^':'Î','o^':'ô','O^':'Ô','u^':'û','U^':'Û','a¨':'ä','A¨':'Ä','e¨':'ë','E¨':'Ë','i¨':'ï','I¨':'Ï','o¨':'ö','O¨':'Ö','u¨':'ü','U¨':'Ü'}
-    for key in brokenAccents.keys():
-        text = text.replace(key, brokenAccents[key])
-    return text
+    # Every single-char fix is a non-ASCII char, so pure ASCII text can skip the translate() pass.
+    if not text.isascii():
+        text = text.translate(singleCharFixTable)
+    # Not the broken accents, though: n~, a`, e^ and friends are plain ASCII.
+    return multiCharFixPattern.sub(lambda match: multiCharFixes[match.group()], text)
 
 def cleanText(text):
     """
@@ -120,68 +185,227 @@ def cleanText(text):
     Output: text (str | text that was cleaned in-place to remove wonky unicode characters)
     Purpose: Removes obviously bad unicode characters.
     """
-    # I *will* just forcibly remove weird characters, man.
-    for char in text:
-        if char in blackListedChars:
-            text = text.replace(char, '')
-    text = ftfy.fix_text(text)
+    # Every blacklisted char is non-ASCII, and on ASCII text ftfy only changes what asciiFtfyPattern matches, so clean
+    # ASCII text needs neither step. Two C-level scans skip both on the common case.
+    if text.isascii() and not asciiFtfyPattern.search(text):
+        return text
+    # I *will* just forcibly remove weird characters, man. (One translate() pass deletes all of them.)
+    # Most PDFs have none, and search() bails out without building a new string, so check first.
+    if blackListPattern.search(text):
+        text = text.translate(blackListTable)
+    # ftfy is the expensive part. On ASCII text it only touches what asciiFtfyPattern looks for, so skip it when that's absent.
+    if not text.isascii() or asciiFtfyPattern.search(text):
+        text = ftfy.fix_text(text)
     return text
 
 
-def checktextQuality(text):
+def findInvalidCodepoints(codepoints):
     """
-    Input: txtFile (str | Text from txt.)
-    Output: gibberScore (float | percentage of words that are gibberish)
-    Purpose: Combined with checkInvalidChars, compared against a threshold for whether OCR should be used as a fallback for parsing
-             difficult PDFs.
+    Input: codepoints (np.ndarray | uint32 codepoints of some text)
+    Output: isInvalid (np.ndarray | bool per codepoint)
+    Purpose: Vectorized checkInvalidChars, one flag per character instead of per word.
     """
-    textWords = textSlicer(text)
-    # Initializing these variables to make the quality score for the text transcription.
+    # One table lookup per char instead of a comparison per range plus set membership tests.
+    return ~allowedBitmap[np.minimum(codepoints, 0xFFFF)]
+
+
+def countInvalidWords(codepoints, isSpace, wordStarts, threshold, blockWords):
+    """
+    Input: codepoints (np.ndarray | uint32 codepoints of the text), isSpace (np.ndarray | bool per codepoint),
+           wordStarts (np.ndarray | index of each word's first codepoint), threshold (float | quality score threshold),
+           blockWords (int | words between verdict checks)
+    Output: invalidWords (int | invalid words seen), scannedWords (int | words scanned before the verdict was settled)
+    Purpose: Counts words containing an invalid char, a block of words at a time, and stops once the quality score can't
+             cross the threshold any more. numpy version; replaced by the compiled one below when numba is installed.
+    """
+    totalWords = wordStarts.size
     invalidWords = 0
-    validWords = 0
-    for word in textWords:
-        if checkInvalidChars(word) == True:
-            print(word)
-            invalidWords += 1
-        else:
-            validWords += 1
-    qualityScore = 1 - (invalidWords / (invalidWords + validWords))
-    print('[NERVE-bio] First-pass PDF quality score (using PyMuPDF): ' + str(qualityScore))
-    return qualityScore
+    scannedWords = 0
+    while scannedWords < totalWords:
+        lastWord = min(scannedWords + blockWords, totalWords)
+        firstChar = wordStarts[scannedWords]
+        lastChar = wordStarts[lastWord] if lastWord < totalWords else codepoints.size
+        isInvalid = findInvalidCodepoints(codepoints[firstChar:lastChar]) & ~isSpace[firstChar:lastChar]
+        # Each segment runs from one word start to the next; trailing spaces are never invalid, so any() per segment is per word.
+        invalidWords += int(np.count_nonzero(np.logical_or.reduceat(isInvalid, wordStarts[scannedWords:lastWord] - firstChar)))
+        scannedWords = lastWord
+        # Best case: every word left is valid. Worst case: every word left is invalid.
+        if 1 - (invalidWords / totalWords) <= threshold or 1 - ((invalidWords + totalWords - scannedWords) / totalWords) > threshold:
+            break
+    return invalidWords, scannedWords
 
 
-def transcribePDF(pdfFile):
+def countInvalidWordsNative(codepoints, isSpace, wordStarts, threshold, blockWords):
     """
-    Input: pdfFile (str | name of PDF)
-    Output: None.
-    Purpose: Uses PyMuPDF as first attempt to parse PDFs. Stores parsed files as internal TXTs. 
-             Initiates pipeline for checking transcription quality.
+    Input/Output: same as countInvalidWords.
+    Purpose: Same count as countInvalidWords as plain loops, for numba to compile. One pass, no temporary arrays, and it
+             stops at a word's first invalid char.
+    """
+    totalWords = wordStarts.size
+    invalidWords = 0
+    for word in range(totalWords):
+        for char in range(wordStarts[word], codepoints.size):
+            if isSpace[char]:
+                break
+            code = codepoints[char]
+            if code > 0xFFFF or not allowedBitmap[code]:
+                invalidWords += 1
+                break
+        scannedWords = word + 1
+        if scannedWords % blockWords == 0 or scannedWords == totalWords:
+            if 1 - (invalidWords / totalWords) <= threshold or 1 - ((invalidWords + totalWords - scannedWords) / totalWords) > threshold:
+                return invalidWords, scannedWords
+    return invalidWords, totalWords
+
+
+if njit is not None:
+    countInvalidWords = njit(cache=True)(countInvalidWordsNative)
+
+
+def checktextQuality(text, earlyExit=True):
+    """
+    Input: text (str | Text from txt.), earlyExit (bool | stop once the verdict is settled; False always scores every word)
+    Output: passed (bool | whether the score is above qualityScoreThreshold),
+            qualityScore (float | fraction of words with no invalid chars, or None if the scan stopped early)
+    Purpose: Combined with checkInvalidChars, compared against a threshold for whether OCR should be used as a fallback for parsing
+             difficult PDFs. By default it stops scanning once the score can't end up on the other side of
+             qualityScoreThreshold, so only the verdict is known; use earlyExit=False when you need the actual scores
+             (e.g. tuning the threshold).
+    """
+    # numpy over the codepoints instead of a Python loop per word.
+    codepoints = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+    isSpace = whitespaceBitmap[np.minimum(codepoints, 0xFFFF)]
+    # A word starts at any non-space char that follows a space (or the start of the text), same as textSlicer.
+    isWordStart = ~isSpace
+    isWordStart[1:] &= isSpace[:-1]
+    wordStarts = np.flatnonzero(isWordStart)
+    totalWords = wordStarts.size
+    if totalWords == 0:
+        print('[NERVE-bio] First-pass PDF quality score (using PyMuPDF): 0.0 (no text)')
+        return False, 0.0
+    # One block covering every word means the verdict is only checked at the very end.
+    blockWords = qualityCheckBlockWords if earlyExit else totalWords
+    invalidWords, scannedWords = countInvalidWords(codepoints, isSpace, wordStarts, qualityScoreThreshold, blockWords)
+    if debugMode:
+        for word in textSlicer(text):
+            if checkInvalidChars(word):
+                print(word)
+        print('[NERVE-bio] checkInvalidChars cache: ' + str(checkInvalidChars.cache_info()))
+    bestScore = 1 - (invalidWords / totalWords)
+    worstScore = 1 - ((invalidWords + totalWords - scannedWords) / totalWords)
+    passed = worstScore > qualityScoreThreshold
+    if scannedWords == totalWords:
+        qualityScore = bestScore
+        print('[NERVE-bio] First-pass PDF quality score (using PyMuPDF): ' + str(qualityScore))
+    else:
+        qualityScore = None
+        bound = ' >= ' + str(worstScore) if passed else ' <= ' + str(bestScore)
+        print('[NERVE-bio] First-pass PDF quality score (using PyMuPDF):' + bound
+              + ' (decided after ' + str(scannedWords) + ' of ' + str(totalWords) + ' words)')
+    return passed, qualityScore
+
+
+def extractPageRange(pdfPath, firstPage, lastPage):
+    """
+    Input: pdfPath (str | path of PDF), firstPage (int | first page index), lastPage (int | page index to stop before)
+    Output: text (str | text of those pages, in order)
+    Purpose: Worker for page-level parallelism in extractPDFText. Opens its own handle on the PDF, since PyMuPDF documents
+             can't be shared between threads or processes.
+    """
+    textBuffer = io.StringIO()
+    with pymupdf.open(pdfPath) as pmPDF:
+        for pageNumber in range(firstPage, lastPage):
+            textBuffer.write(pmPDF[pageNumber].get_text('text', flags=textExtractionFlags))
+    return textBuffer.getvalue()
+
+def extractPDFText(pdfFile, persist=False, pageExecutor=None):
+    """
+    Input: pdfFile (str | name of PDF), persist (bool | also write the cleaned text to its .txt),
+           pageExecutor (ProcessPoolExecutor | pool of pageWorkers processes to split a long PDF's pages across, shared
+           between PDFs; None keeps it in this process)
+    Output: cleanedText (str | cleaned text of the PDF, or None if it failed the quality check)
+    Purpose: Uses PyMuPDF as first attempt to parse PDFs and initiates pipeline for checking transcription quality.
+             Text stays in memory; it only touches disk (as an internal TXT) when persist is set.
     """
     pdfPath = os.path.join(testPDFDir, pdfFile)
-    pmPDF = pymupdf.open(pdfPath)
-    txtPath = os.path.join(testTXTDir, pdfFile[:-4] + '.txt')
-    textOutput = open(txtPath, 'wb')
-    for page in pmPDF:
-        pageText = page.get_text()
-        textOutput.write(pageText.encode('utf-8'))
-    textOutput.close()
-    with open(txtPath, 'r', encoding = 'utf-8') as file:
-        text = file.read()
-        fixedText = fixText(text)
-    if checktextQuality(fixedText) > qualityScoreThreshold:
+    with pymupdf.open(pdfPath) as pmPDF:
+        pageCount = pmPDF.page_count
+        # Only long documents are worth shipping out to the pool.
+        splitPages = pageExecutor is not None and pageCount >= minPagesForPageWorkers
+        if not splitPages:
+            # Pages go straight into one growing buffer rather than a list of page strings waiting to be joined.
+            textBuffer = io.StringIO()
+            for page in pmPDF:
+                textBuffer.write(page.get_text('text', flags=textExtractionFlags))
+            text = textBuffer.getvalue()
+    # Processes, not a thread pool: PyMuPDF isn't thread-safe and holds the GIL while extracting, so threads wouldn't overlap.
+    if splitPages:
+        pagesPerWorker = -(-pageCount // pageWorkers)
+        firstPages = range(0, pageCount, pagesPerWorker)
+        lastPages = [min(firstPage + pagesPerWorker, pageCount) for firstPage in firstPages]
+        text = ''.join(pageExecutor.map(extractPageRange, repeat(pdfPath), firstPages, lastPages))
+    fixedText = fixText(text)
+    passed, _ = checktextQuality(fixedText)
+    if passed:
         cleanedText = cleanText(fixedText)
-        with open(txtPath, 'w', encoding='utf-8') as file:
-            file.write(cleanedText)
+        if persist:
+            writeTXT(getNewTXTPath(pdfFile), cleanedText)
         print('[NERVE-bio] Extracted PDF: ' + pdfFile)
+        return cleanedText
         #print('[NERVE-bio] Failed to Extract PDF: ' + pdfFile)
     # Log to console that PDF text was extracted.
-    
+    return None
+
+
+def genCleaned():
+    """
+    Input: None.
+    Output: generator of (cleanedText, pdfFile) tuples (str, str)
+    Purpose: Lazily extracts every PDF in the PDF directory and yields the cleaned text with its file name, without writing
+             any TXTs. PDFs that fail the quality check are skipped. Meant to be fed straight into
+             languageProcessor.pipe(..., as_tuples=True).
+    """
+    # One pool for the whole run: starting workers (re-importing this module under spawn) costs more than reading a
+    # long PDF serially, so it can't be paid per PDF. nullcontext hands back None, i.e. no page splitting.
+    with ProcessPoolExecutor(max_workers=pageWorkers) if pageWorkers > 1 else nullcontext() as pageExecutor:
+        for pdfFile in listPDFs():
+            cleanedText = extractPDFText(pdfFile, pageExecutor=pageExecutor)
+            if cleanedText is not None:
+                yield cleanedText, pdfFile
+
+
+async def transcribePDFAsync(pdfFile, executor):
+    """
+    Input: pdfFile (str | name of PDF), executor (Executor | runs extractPDFText)
+    Output: cleanedText (str | same as extractPDFText, or None if the PDF couldn't be read)
+    Purpose: Runs extractPDFText (persisting the TXT) off the event loop so many PDFs can be transcribed at once. A PDF that
+             blows up (corrupt file etc.) is logged and skipped instead of taking the rest of the run down with it.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        # Already one PDF per CPU here, so each PDF's pages stay in its own worker (no pageExecutor).
+        return await loop.run_in_executor(executor, extractPDFText, pdfFile, True)
+    except Exception as error:
+        print('[NERVE-bio] Failed to Extract PDF: ' + pdfFile + ' (' + repr(error) + ')')
+        return None
+
+
+async def transcribeAllPDFs():
+    """
+    Input: None.
+    Output: cleanedTexts (list | transcribePDFAsync result per PDF, in directory order)
+    Purpose: Transcribes every PDF in the PDF directory to TXT concurrently, at most one per CPU at a time (the pool size
+             is the cap).
+    """
+    # nts: when the pytesseract fallback lands, look at aiopytesseract so OCR pages can run as async subprocesses too.
+    with ProcessPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        return await asyncio.gather(*(transcribePDFAsync(pdfFile, executor) for pdfFile in listPDFs()))
 
 
 # nts: remove stuff here that hard codes directory for PDFs; users will input using UI
 
-for file in os.listdir(testPDFDir):
-    transcribePDF(file)
+if __name__ == "__main__":
+    asyncio.run(transcribeAllPDFs())
 
 
 